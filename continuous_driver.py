@@ -103,12 +103,8 @@ def runner():
     #                           CREATING THE SIMULATION
     #========================================================================
 
-    try:
-        client, world = ClientConnection(town).setup()
-        logging.info("Connection has been setup successfully.")
-    except:
-        logging.error("Connection has been refused by the server.")
-        ConnectionRefusedError
+    client, world = ClientConnection(town).connect()
+    logging.info("Connection has been setup successfully.")
     if train:
         env = CarlaEnvironment(client, world,town)
     else:
@@ -289,6 +285,7 @@ def runner():
             sys.exit()
 
     finally:
+        env.close()
         sys.exit()
 
 
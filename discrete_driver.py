@@ -5,17 +5,20 @@ import random
 import numpy as np
 import argparse
 import logging
+import logging.handlers
 import pickle
+import queue
+import signal
 import torch
 from distutils.util import strtobool
-from threading import Thread
+from threading import Thread, Lock
+from collections import deque
 from datetime import datetime
 from torch.utils.tensorboard import SummaryWriter
-from simulation.connection import ClientConnection
-from simulation.environment import CarlaEnvironment
+from simulation.vec_env import SubprocVecEnv
 from networks.off_policy.ddqn.agent import DQNAgent
 from encoder_init import EncodeState
-from parameters import *
+from parameters import DQN_LEARNING_RATE, SEED, EPISODES, MODEL_LOAD, LEARN_EVERY, LATENT_DIM, ENCODE_BATCH_SIZE, BATCH_SIZE, IM_WIDTH, IM_HEIGHT
 
 
 def parse_args():
@@ -24,18 +27,120 @@ def parse_args():
     parser.add_argument('--exp-name', type=str, help='name of the experiment')
     parser.add_argument('--env-name', type=str, default='carla', help='name of the simulation environment')
     parser.add_argument('--learning-rate', type=float, default=DQN_LEARNING_RATE, help='learning rate of the optimizer')
+    parser.add_argument('--learn-every', type=int, default=LEARN_EVERY, help='number of env steps between two learning steps')
     parser.add_argument('--seed', type=int, default=SEED, help='seed of the experiment')
     parser.add_argument('--total-episodes', type=int, default=EPISODES, help='total timesteps of the experiment')
     parser.add_argument('--train', type=bool, default=True, help='is it training?')
     parser.add_argument('--town', type=str, default="Town07", help='which town do you like?')
+    parser.add_argument('--num-envs', type=int, default=1, help='number of CARLA servers (on ports 2000, 2002, ...) to collect experience from in parallel')
     parser.add_argument('--load-checkpoint', type=bool, default=MODEL_LOAD, help='resume training?')
     parser.add_argument('--torch-deterministic', type=lambda x:bool(strtobool(x)), default=True, nargs='?', const=True, help='if toggled, `torch.backends.cudnn.deterministic=False`')
     parser.add_argument('--cuda', type=lambda x:bool(strtobool(x)), default=True, nargs='?', const=True, help='if toggled, cuda will not be enabled by deafult')
+    parser.add_argument('--profile', type=lambda x:bool(strtobool(x)), default=False, nargs='?', const=True, help='if toggled, the first episode is traced with the torch profiler')
     args = parser.parse_args()
     
     return args
 
 
+# Log records are queued as they are and formatted & written out by a listener thread,
+# keeping string formatting and stdout I/O off the training loop.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+def setup_logging():
+    log_queue = queue.Queue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    return listener
+
+
+# Pickles the CUDA caching allocator's segments, to look into fragmentation & what's holding memory
+# (e.g. with https://pytorch.org/memory_viz) after running out of it late in a long run.
+def dump_memory_snapshot(snapshot_file):
+    if torch.cuda.is_available():
+        with open(snapshot_file, 'wb') as handle:
+            pickle.dump(torch.cuda.memory_snapshot(), handle, protocol=pickle.HIGHEST_PROTOCOL)
+        logging.info("CUDA memory snapshot written to %s", snapshot_file)
+
+
+def is_out_of_memory(error):
+    return isinstance(error, RuntimeError) and 'out of memory' in str(error)
+
+
+# Consumes transitions from the rollout (main) thread: stores them and runs a gradient step
+# every `learn_every` transitions, so that learning overlaps with the blocking CARLA calls.
+# Epsilon still decays once per transition, while the target network is synced every
+# REPLACE_NETWORK gradient steps, i.e. every REPLACE_NETWORK * learn_every transitions.
+# Whatever ends the thread (e.g. running out of memory) is handed to the main thread through
+# `errors`, where the memory snapshot is dumped: the traceback keeps the thread's tensors alive.
+def learner(agent, transitions, learn_every, lock, errors):
+    try:
+        while True:
+            observation, action, reward, new_observation, done = transitions.get()
+            agent.save_transition(observation, action, reward, new_observation, done)
+            agent.decrese_epsilon()
+            if agent.replay_buffer.counter % learn_every == 0:
+                with lock:
+                    agent.learn()
+            transitions.task_done()
+    except Exception as e:
+        errors.put(e)
+
+
+# An exception in a background thread only ends that thread, it's re-raised here on the main thread instead.
+def raise_thread_error(errors):
+    if not errors.empty():
+        raise errors.get()
+
+
+# Waits for room in the queue without blocking for good, as a dead learner would never make any.
+def hand_over(transitions, transition, errors):
+    while True:
+        raise_thread_error(errors)
+        try:
+            transitions.put(transition, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+# Runs in its own thread so that the rollout goes on while the checkpoint is written.
+# Holding the lock keeps learning steps and other saves from changing the agent meanwhile.
+# A failed save is handed to the main thread through `errors`, stopping the training as it used to.
+def save_checkpoint(agent, exp_name, cumulative_score, step, lock, errors):
+    try:
+        with lock:
+            agent.save_model()
+
+            if exp_name == 'ddqn':
+                data_obj = {'cumulative_score': cumulative_score, 'epsilon': agent.epsilon,'epoch': step}
+                with open(f'checkpoints/DDQN/{agent.town}/checkpoint_ddqn.pickle', 'wb') as handle:
+                    pickle.dump(data_obj, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        errors.put(e)
+
+
+
+# Runs the encoder and the networks a couple of times on dummy frames, for every batch size seen in
+# training, so that the first episodes don't pay for TorchScript's graph optimisation, cuDNN's
+# autotuning or growing the encoder's staging buffers. The encoder gets any number of frames up to
+# one per env (stepped or reset envs) or ENCODE_BATCH_SIZE (filling the buffer), the actions are
+# chosen for up to one observation per env and the learning steps take a minibatch.
+def warmup(agent, encode, num_envs):
+    observation = [np.zeros((IM_WIDTH, IM_HEIGHT, 3), dtype=np.uint8), np.zeros(5)]
+    for _ in range(2):
+        for batch_size in range(1, max(num_envs, ENCODE_BATCH_SIZE) + 1):
+            latents = encode.process_batch([observation] * batch_size)
+            if batch_size <= num_envs:
+                agent.get_actions(latents)
+        agent.warmup(torch.stack(encode.process_batch([observation] * BATCH_SIZE)))
+
+
 
 def runner():
 
@@ -45,6 +150,7 @@ def runner():
     
     args = parse_args()
     exp_name = args.exp_name
+    listener = setup_logging()
     
     try:
         if exp_name == 'ddqn':
@@ -54,16 +160,26 @@ def runner():
         sys.exit()
 
     town = args.town
+    episodes = args.total_episodes
     writer = SummaryWriter(f"runs/{run_name}/{town}")
     writer.add_text(
         "hyperparameters",
         "|param|value|\n|-|-|\n%s" % ("\n".join([f"|{key}|{value}" for key, value in vars(args).items()])))
+
+    # The allocator state is dumped when running out of memory, or on demand with `kill -USR1 <pid>`
+    snapshot_file = f"runs/{run_name}/oom_snapshot.pickle"
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump_memory_snapshot(snapshot_file))
     
     #Seeding to reproduce the results 
     random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     torch.backends.cudnn.deterministic = args.torch_deterministic
+    # TF32 matmuls and cuDNN autotuning are only allowed when results needn't be reproducible
+    torch.backends.cuda.matmul.allow_tf32 = not args.torch_deterministic
+    torch.backends.cudnn.allow_tf32 = not args.torch_deterministic
+    torch.backends.cudnn.benchmark = not args.torch_deterministic
     
     
     #========================================================================
@@ -72,19 +188,20 @@ def runner():
 
     checkpoint_load = args.load_checkpoint
     n_actions = 7  # Car can only make 7 actions
-    agent = DQNAgent(n_actions)
+    agent = DQNAgent(town, n_actions)
     
     epoch = 0
     cumulative_score = 0
     episodic_length = list()
-    scores = list()
+    # Only the latest episodes are needed for the averages logged to tensorboard
+    scores = deque(maxlen=10)
     deviation_from_center = 0
     distance_covered = 0
 
     if checkpoint_load:
         agent.load_model()
         if exp_name == 'ddqn':
-            with open('checkpoints/DDQN/{town}/checkpoint_ddqn.pickle', 'rb') as f:
+            with open(f'checkpoints/DDQN/{town}/checkpoint_ddqn.pickle', 'rb') as f:
                 data = pickle.load(f)
                 epoch = data['epoch']
                 cumulative_score = data['cumulative_score']
@@ -95,16 +212,11 @@ def runner():
     #                           CREATING THE SIMULATION
     #========================================================================
 
-    try:
-        client, world = ClientConnection(town).setup()
-
-        logging.info("Connection has been setup successfully.")
-    except:
-        logging.error("Connection has been refused by the server.")
-        ConnectionRefusedError
-
-    env = CarlaEnvironment(client, world, town, continuous_action=False)
+    # Each env runs in its own process with its own client & server
+    num_envs = args.num_envs
+    vec_env = SubprocVecEnv(town, num_envs, continuous_action=False)
     encode = EncodeState(LATENT_DIM)
+    warmup(agent, encode, num_envs)
 
 
 
@@ -115,96 +227,187 @@ def runner():
         #========================================================================
     
         if exp_name == 'ddqn' and checkpoint_load:
+            # Actions are random here, so each env's frames are encoded in micro-batches of ENCODE_BATCH_SIZE.
+            # The last latent of a batch is carried over as the first observation of the next one: the
+            # encoder samples its latents, encoding that frame again would give a different one.
+            pending = [(latent, [], [], [], []) for latent in encode.process_batch(vec_env.reset())]
+            # Enough random actions for every env to fill the buffer on its own, drawn all at once
+            random_actions = np.random.randint(0, n_actions, size=(agent.replay_buffer.buffer_size, num_envs), dtype=np.int8)
+            t = 0
             while agent.replay_buffer.counter < agent.replay_buffer.buffer_size:
-                observation = env.reset()
-                observation = encode.process(observation)
-                done = False
-                while not done:
-                    action = random.randint(0,n_actions-1)
-                    new_observation, reward, done, _ = env.step(action)
-                    new_observation = encode.process(new_observation)
-                    agent.save_transition(observation, action, reward, new_observation, int(done))
-                    observation = new_observation
-
-
-        if args.train:
-            #========================================================================
-            #                           ALGORITHM
-            #========================================================================
-
-            for step in range(epoch+1, EPISODES+1):
-                if exp_name == 'ddqn':
-                    print('Starting Episode: ', step, ', Epsilon Now:  {:.3f}'.format(agent.epsilon), ', ', end="")
-
-                #Reset
-                done = False
-                observation = env.reset()
-                observation = encode.process(observation)
-                current_ep_reward = 0
+                actions = random_actions[t % len(random_actions)].tolist()
+                t += 1
+                new_observations, rewards, dones, _ = vec_env.step(actions)
 
-                #Episode start: timestamp
-                t1 = datetime.now()
+                finished = list()
+                for i in range(num_envs):
+                    if new_observations[i] is None:
+                        finished.append(i)
+                        continue
 
-                while not done:
+                    latent, frames, env_actions, env_rewards, env_dones = pending[i]
+                    frames.append(new_observations[i])
+                    env_actions.append(actions[i])
+                    env_rewards.append(rewards[i])
+                    env_dones.append(dones[i])
 
-                    action = agent.get_action(observation)
-                    new_observation, reward, done, info = env.step(action)
-                    if new_observation is None:
-                        break
-                    new_observation = encode.process(new_observation)
-                    current_ep_reward += reward
+                    if len(frames) == ENCODE_BATCH_SIZE or dones[i]:
+                        latents = [latent] + encode.process_batch(frames)
+                        for j in range(len(env_actions)):
+                            agent.save_transition(latents[j], env_actions[j], env_rewards[j], latents[j+1], int(env_dones[j]))
+                        pending[i] = (latents[-1], [], [], [], [])
 
-                    agent.save_transition(observation, action, reward, new_observation, int(done))
-                    agent.learn()
+                    if dones[i]:
+                        finished.append(i)
 
-                    observation = new_observation
+                if finished:
+                    for i, latent in zip(finished, encode.process_batch(vec_env.reset(finished))):
+                        pending[i] = (latent, [], [], [], [])
 
-                #Episode end : timestamp
-                t2 = datetime.now()
-                t3 = t2-t1
-                episodic_length.append(abs(t3.total_seconds()))
 
+        if args.train:
+            #========================================================================
+            #                           ALGORITHM
+            #========================================================================
 
-                deviation_from_center += info[1]
-                distance_covered += info[0]
-                
-                scores.append(current_ep_reward)
+            # Environment interaction stays on the main thread (the CARLA clients live in the env workers),
+            # the replay buffer and the gradient steps are handled by the learner thread.
+            transitions = queue.Queue(maxsize=4)
+            errors = queue.Queue()
+            lock = Lock()
+            train_thread = Thread(target=learner, args=(agent, transitions, args.learn_every, lock, errors), daemon=True)
+            train_thread.start()
+
+            #Reset
+            observations = encode.process_batch(vec_env.reset())
+            current_ep_rewards = [0] * num_envs
+
+            #Episode start: timestamp
+            t1 = [datetime.now()] * num_envs
+
+            #Profiling: a few steps of the first episode are traced, `tensorboard --logdir runs/` to see them
+            prof = None
+            if args.profile:
+                prof = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU, torch.profiler.ProfilerActivity.CUDA],
+                    schedule=torch.profiler.schedule(wait=1, warmup=1, active=3, repeat=1),
+                    on_trace_ready=torch.profiler.tensorboard_trace_handler(f"runs/{run_name}/profiler"),
+                    record_shapes=True, profile_memory=True, with_stack=True)
+                prof.start()
+
+            actions = agent.get_actions(observations)
+            vec_env.step_async(actions)
+
+            save_thread = None
+            step = epoch
+            while step < episodes:
+
+                new_observations, rewards, dones, infos = vec_env.step_wait()
+
+                # All the new frames are encoded in one batch, skipping envs whose simulation failed
+                valid = [i for i in range(num_envs) if new_observations[i] is not None]
+                new_latents = dict(zip(valid, encode.process_batch([new_observations[i] for i in valid]))) if valid else dict()
+
+                # The envs still in their episode get their next action right away, so the simulators
+                # already run the next step while this one is handed to the learner and logged
+                next_actions = list(actions)
+                running = [i for i in valid if not dones[i]]
+                if running:
+                    for i, action in zip(running, agent.get_actions([new_latents[i] for i in running])):
+                        next_actions[i] = action
+                    vec_env.step_async([next_actions[i] for i in running], running)
+
+                finished = list()
+                for i in range(num_envs):
+                    if new_observations[i] is None:
+                        finished.append(i)
+                        continue
+
+                    new_observation = new_latents[i]
+                    current_ep_rewards[i] += rewards[i]
+                    hand_over(transitions, (observations[i], actions[i], rewards[i], new_observation, int(dones[i])), errors)
+                    observations[i] = new_observation
+
+                    if not dones[i]:
+                        continue
+                    finished.append(i)
+                    # Other envs may finish in the same iteration as the last episode, those aren't counted
+                    if step == episodes:
+                        continue
+                    step += 1
+                    current_ep_reward = current_ep_rewards[i]
+
+                    #Episode end : timestamp
+                    t2 = datetime.now()
+                    t3 = t2-t1[i]
+                    episodic_length.append(abs(t3.total_seconds()))
+
+
+                    deviation_from_center += infos[i][1]
+                    distance_covered += infos[i][0]
+                    
+                    scores.append(current_ep_reward)
 
-                if checkpoint_load:
                     cumulative_score = ((cumulative_score * (step - 1)) + current_ep_reward) / (step)
-                else:
-                    cumulative_score = np.mean(scores)
-
-                print('Reward:  {:.2f}'.format(current_ep_reward), ', Average Reward:  {:.2f}'.format(cumulative_score))
 
-
-                if step >= 10 and step % 10 == 0:
-                    agent.save_model()
-
-                    if exp_name == 'ddqn':
-                        data_obj = {'cumulative_score': cumulative_score, 'epsilon': agent.epsilon,'epoch': step}
-                        with open('checkpoints/DDQN/{town}/checkpoint_ddqn.pickle', 'wb') as handle:
-                            pickle.dump(data_obj, handle)
-
-                    writer.add_scalar("Cumulative Reward/info", cumulative_score, step)
-                    writer.add_scalar("Epsilon/info", agent.epsilon, step)
-                    writer.add_scalar("Episodic Reward/episode", scores[-1], step)
-                    writer.add_scalar("Average Episodic Reward/info", np.mean(scores[-10]), step)
-                    writer.add_scalar("Episode Length (s)/info", np.mean(episodic_length), step)
-                    writer.add_scalar("Average Deviation from Center/episode", deviation_from_center/10, step)
-                    writer.add_scalar("Average Distance Covered (m)/episode", distance_covered/10, step)
-
-                    episodic_length = list()
-                    deviation_from_center = 0
-                    distance_covered = 0
+                    logging.info("Episode: %d, Epsilon Now: %.3f, Reward: %.2f, Average Reward: %.2f", step, agent.epsilon, current_ep_reward, cumulative_score)
+
+
+                    if step >= 10 and step % 10 == 0:
+                        # Not a daemon: the interpreter waits for a checkpoint being written before exiting
+                        save_thread = Thread(target=save_checkpoint, args=(agent, exp_name, cumulative_score, step, lock, errors))
+                        save_thread.start()
+
+                        writer.add_scalar("Cumulative Reward/info", cumulative_score, step)
+                        writer.add_scalar("Epsilon/info", agent.epsilon, step)
+                        writer.add_scalar("Episodic Reward/episode", scores[-1], step)
+                        writer.add_scalar("Average Episodic Reward/info", np.mean(scores), step)
+                        writer.add_scalar("Episode Length (s)/info", np.mean(episodic_length), step)
+                        writer.add_scalar("Average Deviation from Center/episode", deviation_from_center/10, step)
+                        writer.add_scalar("Average Distance Covered (m)/episode", distance_covered/10, step)
+
+                        episodic_length = list()
+                        deviation_from_center = 0
+                        distance_covered = 0
+
+                #Reset the envs whose episode is over, and start their next one
+                if finished and step < episodes:
+                    reset_observations = encode.process_batch(vec_env.reset(finished))
+                    for i, observation, action in zip(finished, reset_observations, agent.get_actions(reset_observations)):
+                        observations[i] = observation
+                        next_actions[i] = action
+                        current_ep_rewards[i] = 0
+                        t1[i] = datetime.now()
+                    vec_env.step_async([next_actions[i] for i in finished], finished)
+
+                actions = next_actions
+
+                if prof is not None:
+                    prof.step()
+                    if step > epoch:
+                        prof.stop()
+                        prof = None
+
+            # The last checkpoint must have been written, and without an error, before we're done
+            if save_thread is not None:
+                save_thread.join()
+            raise_thread_error(errors)
 
             print("Terminating the run.")
             sys.exit()
         else:
             sys.exit()
 
+    # The learner thread's errors are re-raised in the loop, so they end up here too
+    except RuntimeError as e:
+        if is_out_of_memory(e):
+            dump_memory_snapshot(snapshot_file)
+        raise
+
+    # No sys.exit() here, it would turn an error into a clean (zero) exit status
     finally:
-        sys.exit()
+        vec_env.close()
+        # Flushes whatever is still waiting in the log queue
+        listener.stop()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,15 @@
 import sys
+import numpy as np
 import torch
 from autoencoder.encoder import VariationalEncoder
+from parameters import IM_WIDTH, IM_HEIGHT
 
 class EncodeState():
     def __init__(self, latent_dim):
         self.latent_dim = latent_dim
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # bfloat16 autocast for the encoder's forward pass on GPUs supporting it (Ampere onwards)
+        self.autocast = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
         
         try:
             self.conv_encoder = VariationalEncoder(self.latent_dim).to(self.device)
@@ -14,16 +18,54 @@ class EncodeState():
 
             for params in self.conv_encoder.parameters():
                 params.requires_grad = False
+
+            # TorchScript the convolutional and linear trunk, freezing also folds the batch norms
+            # into the convolutions. The latent sampling (torch.distributions) stays in python.
+            for name in ('encoder_layer1', 'encoder_layer2', 'encoder_layer3', 'encoder_layer4', 'linear'):
+                setattr(self.conv_encoder, name, torch.jit.freeze(torch.jit.script(getattr(self.conv_encoder, name))))
         except:
             print('Encoder could not be initialized.')
             sys.exit()
+
+        # Staging buffers for the frames: pinned host memory lets the upload run asynchronously.
+        # They grow when a bigger batch than they can hold comes in.
+        if self.device.type == 'cuda':
+            self._host_buf = torch.empty((1, IM_WIDTH, IM_HEIGHT, 3), dtype=torch.uint8, pin_memory=True)
+            self._dev_buf = torch.empty((1, IM_WIDTH, IM_HEIGHT, 3), dtype=torch.uint8, device=self.device)
+            self._copy_done = torch.cuda.Event()
     
     def process(self, observation):
-        image_obs = torch.tensor(observation[0], dtype=torch.float).to(self.device)
-        image_obs = image_obs.unsqueeze(0)
-        image_obs = image_obs.permute(0,3,2,1)
-        image_obs = self.conv_encoder(image_obs)
-        navigation_obs = torch.tensor(observation[1], dtype=torch.float).to(self.device)
-        observation = torch.cat((image_obs.view(-1), navigation_obs), -1)
-        
-        return observation
\ No newline at end of file
+        return self.process_batch([observation])[0]
+
+    # Encodes several observations with a single forward pass of the encoder.
+    def process_batch(self, observations):
+        with torch.inference_mode():
+            # Frames are uploaded as uint8 and only converted to float on the device (4x less to copy)
+            image_obs = self._upload_frames([obs[0] for obs in observations])
+            image_obs = image_obs.permute(0,3,2,1).float()
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.autocast):
+                image_obs = self.conv_encoder(image_obs)
+            image_obs = image_obs.float()
+            navigation_obs = torch.as_tensor(np.stack([obs[1] for obs in observations]), dtype=torch.float, device=self.device)
+            observations = torch.cat((image_obs, navigation_obs), -1)
+
+        return list(observations)
+
+    def _upload_frames(self, frames):
+        if self.device.type != 'cuda':
+            return torch.from_numpy(np.stack(frames))
+
+        if len(frames) > len(self._host_buf):
+            self._host_buf = torch.empty((len(frames),) + self._host_buf.shape[1:], dtype=torch.uint8, pin_memory=True)
+            self._dev_buf = torch.empty((len(frames),) + self._dev_buf.shape[1:], dtype=torch.uint8, device=self.device)
+        else:
+            # The previous upload must be done reading the host buffer before we overwrite it
+            self._copy_done.synchronize()
+
+        host_frames = self._host_buf[:len(frames)].numpy()
+        for i, frame in enumerate(frames):
+            host_frames[i] = frame
+        dev_buf = self._dev_buf[:len(frames)]
+        dev_buf.copy_(self._host_buf[:len(frames)], non_blocking=True)
+        self._copy_done.record()
+        return dev_buf
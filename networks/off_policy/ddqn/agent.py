@@ -3,12 +3,13 @@ import numpy as np
 from encoder_init import EncodeState
 from networks.off_policy.ddqn.dueling_dqn import DuelingDQnetwork
 from networks.off_policy.replay_buffer import ReplayBuffer
-from parameters import *
+from parameters import GAMMA, DQN_LEARNING_RATE, EPSILON, EPSILON_END, EPSILON_DECREMENT, MEMORY_SIZE, BATCH_SIZE, REPLACE_NETWORK, MODEL_ONLINE, MODEL_TARGET
 
 
 class DQNAgent(object):
 
-    def __init__(self, n_actions):
+    def __init__(self, town, n_actions):
+        self.town = town
         self.gamma = GAMMA
         self.alpha = DQN_LEARNING_RATE
         self.epsilon = EPSILON
@@ -19,22 +20,29 @@ class DQNAgent(object):
         self.train_step = 0
         #self.encode = EncodeState(LATENT_DIM)
         self.replay_buffer = ReplayBuffer(MEMORY_SIZE,100, n_actions)
-        self.q_network_eval = DuelingDQnetwork(n_actions, MODEL_ONLINE)
-        self.q_network_target = DuelingDQnetwork(n_actions, MODEL_TARGET)
+        self.q_network_eval = DuelingDQnetwork(n_actions, MODEL_ONLINE, town)
+        self.q_network_target = DuelingDQnetwork(n_actions, MODEL_TARGET, town)
 
     def save_transition(self, observation, action,  reward, new_observation, done):
         self.replay_buffer.save_transition(observation, action, reward, new_observation, done)
 
     def get_action(self, observation):
         if np.random.random() > self.epsilon:
-            #observation = self.encode.process(observation)
-            #observation = torch.tensor(observation, dtype=torch.float).to(self.q_network_eval.device)
-            _, advantage = self.q_network_eval.forward(observation)
+            # The encoded observation is already on the device, the chosen action is the only sync
+            with torch.inference_mode():
+                _, advantage = self.q_network_eval.forward(observation)
             action = torch.argmax(advantage).item()
         else:
             action = np.random.choice(self.action_space)
         return action
 
+    # One action per observation, the greedy ones are taken from a single batched forward pass
+    def get_actions(self, observations):
+        with torch.inference_mode():
+            _, advantage = self.q_network_eval.forward(torch.stack(observations))
+        greedy_actions = torch.argmax(advantage, dim=-1).tolist()
+        return [action if np.random.random() > self.epsilon else np.random.choice(self.action_space) for action in greedy_actions]
+
     def decrese_epsilon(self):
         if self.epsilon > self.epsilon_end:
             self.epsilon -= EPSILON_DECREMENT
@@ -49,23 +57,25 @@ class DQNAgent(object):
         self.q_network_eval.load_checkpoint()
         self.q_network_target.load_checkpoint()
 
+    # Forward & backward pass on dummy observations, without updating anything, so that the
+    # one-off costs (CUDA/cuBLAS init, TorchScript's profiling runs) are paid before training.
+    def warmup(self, observations):
+        Vs, As = self.q_network_eval.forward(observations)
+        self.q_network_target.forward(observations)
+        (Vs.sum() + As.sum()).backward()
+        self.q_network_eval.optimizer.zero_grad(set_to_none=True)
+
     def learn(self):
         if self.replay_buffer.counter < self.batch_size:
             return
 
-        self.q_network_eval.optimizer.zero_grad()
+        self.q_network_eval.optimizer.zero_grad(set_to_none=True)
 
         if self.train_step % REPLACE_NETWORK == 0:
             self.q_network_target.load_state_dict(self.q_network_eval.state_dict())
 
+        # The replay buffer lives on the same device as the networks, no transfer needed
         observation, action, reward, new_observation, done = self.replay_buffer.sample_buffer()
- 
-
-        observation = observation.to(self.q_network_eval.device)
-        action = action.to(self.q_network_eval.device)
-        reward = reward.to(self.q_network_eval.device)
-        new_observation = new_observation.to(self.q_network_eval.device)
-        done = done.to(self.q_network_eval.device)
 
 
         Vs, As = self.q_network_eval.forward(observation)
@@ -77,5 +87,4 @@ class DQNAgent(object):
         loss = self.q_network_eval.loss(q_target, q_pred).to(self.q_network_eval.device)
         loss.backward()
         self.q_network_eval.optimizer.step()
-        self.train_step += 1
-        self.decrese_epsilon()
\ No newline at end of file
+        self.train_step += 1
\ No newline at end of file
@@ -2,28 +2,30 @@ import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from parameters import DQN_LEARNING_RATE, DQN_CHECKPOINT_DIR, TOWN7
+from parameters import DQN_LEARNING_RATE, DQN_CHECKPOINT_DIR
 
 
 class DuelingDQnetwork(nn.Module):
-    def __init__(self, n_actions, model):
+    def __init__(self, n_actions, model, town):
         super(DuelingDQnetwork, self).__init__()
         self.n_actions = n_actions
-        self.checkpoint_file = os.path.join(DQN_CHECKPOINT_DIR + '/' + TOWN7, model)
+        self.checkpoint_file = os.path.join(DQN_CHECKPOINT_DIR + '/' + town, model)
 
-        self.Linear1 = nn.Sequential(
+        # Scripted to cut the per-layer python overhead of the tiny batches we get in get_action
+        self.Linear1 = torch.jit.script(nn.Sequential(
             nn.Linear(95 + 5, 256),
             nn.ReLU(),
             nn.Linear(256, 128),
             nn.ReLU(),
             nn.Linear(128, 64),
             nn.ReLU()
-        )
+        ))
 
         self.V = nn.Linear(64, 1)
         self.A = nn.Linear(64, self.n_actions)
 
-        self.optimizer = optim.Adam(self.parameters(), lr=DQN_LEARNING_RATE)
+        # Multi-tensor (foreach) Adam updates all parameters in a few kernels instead of a loop over them
+        self.optimizer = optim.Adam(self.parameters(), lr=DQN_LEARNING_RATE, foreach=True)
         self.loss = nn.MSELoss()
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.to(self.device)
@@ -1,4 +1,3 @@
-import numpy as np
 import torch
 from parameters import BATCH_SIZE
 
@@ -10,11 +9,16 @@ class ReplayBuffer(object):
         self.n_actions = n_actions
         self.buffer_size = max_size
         self.counter = 0
-        self.state_memory = torch.zeros((self.buffer_size, observation), dtype=torch.float32)
-        self.new_state_memory = torch.zeros((self.buffer_size, observation), dtype=torch.float32)
-        self.action_memory = torch.zeros(self.buffer_size, dtype=torch.int64)
-        self.reward_memory = torch.zeros(self.buffer_size, dtype=torch.float32)
-        self.terminal_memory = torch.zeros(self.buffer_size, dtype=torch.bool)
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        # The whole buffer is pre-allocated on the device: encoded states are already there,
+        # and sampling a minibatch is a gather on the device instead of a host to device copy.
+        # Latent states are kept in half precision and cast back to float32 when sampled.
+        self.state_memory = torch.zeros((self.buffer_size, observation), dtype=torch.float16, device=self.device)
+        self.new_state_memory = torch.zeros((self.buffer_size, observation), dtype=torch.float16, device=self.device)
+        self.action_memory = torch.zeros(self.buffer_size, dtype=torch.int64, device=self.device)
+        self.reward_memory = torch.zeros(self.buffer_size, dtype=torch.float32, device=self.device)
+        self.terminal_memory = torch.zeros(self.buffer_size, dtype=torch.bool, device=self.device)
 
     def save_transition(self, state, action, reward, new_state, done):
 
@@ -29,10 +33,10 @@ class ReplayBuffer(object):
 
     def sample_buffer(self):
         max = min(self.counter, self.buffer_size)
-        batch = np.random.choice(max, BATCH_SIZE, replace=False)
+        batch = torch.randint(max, (BATCH_SIZE,), device=self.device)
 
-        states = self.state_memory[batch]
-        new_states = self.new_state_memory[batch]
+        states = self.state_memory[batch].float()
+        new_states = self.new_state_memory[batch].float()
         actions = self.action_memory[batch]
         rewards = self.reward_memory[batch]
         dones = self. terminal_memory[batch]
@@ -3,12 +3,29 @@ import numpy as np
 
 import torch
 import torch.nn as nn
+from numba import njit
 from encoder_init import EncodeState
 from networks.on_policy.ppo.ppo import ActorCritic
 from parameters import  *
 
 device = torch.device("cpu")
 
+
+# Monte Carlo estimate of returns, compiled since it's a sequential loop over the whole rollout
+@njit(cache=True, fastmath=True)
+def discounted_returns(rewards, dones, gamma):
+    returns = np.zeros_like(rewards)
+    discounted_reward = 0.0
+    for i in range(len(rewards) - 1, -1, -1):
+        if dones[i]:
+            discounted_reward = 0.0
+        discounted_reward = rewards[i] + (gamma * discounted_reward)
+        returns[i] = discounted_reward
+    return returns
+
+# Compiling at import time so that the first learn() doesn't stall on it
+discounted_returns(np.zeros(1, dtype=np.float32), np.zeros(1, dtype=np.bool_), 0.99)
+
 class Buffer:
     def __init__(self):
          # Batch data
@@ -82,16 +99,10 @@ class PPOAgent(object):
     def learn(self):
 
         # Monte Carlo estimate of returns
-        rewards = []
-        discounted_reward = 0
-        for reward, is_terminal in zip(reversed(self.memory.rewards), reversed(self.memory.dones)):
-            if is_terminal:
-                discounted_reward = 0
-            discounted_reward = reward + (self.gamma * discounted_reward)
-            rewards.insert(0, discounted_reward)
+        rewards = discounted_returns(np.array(self.memory.rewards, dtype=np.float32), np.array(self.memory.dones, dtype=np.bool_), self.gamma)
             
         # Normalizing the rewards
-        rewards = torch.tensor(rewards, dtype=torch.float32).to(device)
+        rewards = torch.from_numpy(rewards).to(device)
         rewards = (rewards - rewards.mean()) / (rewards.std() + 1e-7)
 
         # convert list to tensor
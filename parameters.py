@@ -15,9 +15,11 @@ EPISODES = 1000
 
 #VAE Bottleneck
 LATENT_DIM = 95
+ENCODE_BATCH_SIZE = 8
 
 #Dueling DQN (hyper)parameters
 DQN_LEARNING_RATE = 0.0001
+LEARN_EVERY = 4
 EPSILON = 1.00
 EPSILON_END = 0.05
 EPSILON_DECREMENT = 0.00001
@@ -1,6 +1,7 @@
 import os
 import sys
 import glob
+import time
 
 try:
     sys.path.append(glob.glob('./carla/carla-*%d.%d-%s.egg' % (
@@ -11,36 +12,42 @@ except IndexError:
     print('Couldn\'t import Carla egg properly')
 
 import carla
-from simulation.settings import PORT, TIMEOUT, HOST
+from simulation.settings import PORT, TIMEOUT, HOST, CONNECTION_ATTEMPTS
 
 class ClientConnection:
-    def __init__(self, town):
+    def __init__(self, town, port=PORT):
         self.client = None
         self.town = town
+        self.port = port
 
     def setup(self):
-        try:
-
-            # Connecting to the  Server
-            self.client = carla.Client(HOST, PORT)
-            self.client.set_timeout(TIMEOUT)
-            self.world = self.client.load_world(self.town)
-            self.world.set_weather(carla.WeatherParameters.CloudyNoon)
-            return self.client, self.world
-
-        except Exception as e:
-            print(
-                'Failed to make a connection with the server: {}'.format(e))
-            self.error()
-
-    # An error method: prints out the details if the client failed to make a connection
+        # Connecting to the  Server
+        self.client = carla.Client(HOST, self.port)
+        self.client.set_timeout(TIMEOUT)
+        self.world = self.client.load_world(self.town)
+        self.world.set_weather(carla.WeatherParameters.CloudyNoon)
+        return self.client, self.world
+
+    # Retries the setup with an exponential backoff (e.g. while the server is still starting up),
+    # and raises the last error once all attempts failed instead of going on without a client.
+    def connect(self):
+        for attempt in range(CONNECTION_ATTEMPTS):
+            try:
+                return self.setup()
+            # The carla client raises RuntimeError for a refused connection & a timeout alike
+            except RuntimeError as e:
+                if attempt == CONNECTION_ATTEMPTS - 1:
+                    print(
+                        'Failed to make a connection with the server: {}'.format(e))
+                    self.error()
+                    raise
+                time.sleep(2**attempt)
+
+    # An error method: prints out the details if the client failed to make a connection.
+    # The server is not asked for its version, it's the one we couldn't reach.
     def error(self):
 
         print("\nClient version: {}".format(
             self.client.get_client_version()))
-        print("Server version: {}\n".format(
-            self.client.get_server_version()))
-
-        if self.client.get_client_version != self.client.get_server_version:
-            print(
-                "There is a Client and Server version mismatch! Please install or download the right versions.")
+        print(
+            "Make sure a CARLA server of the same version is running on {}:{}.\n".format(HOST, self.port))
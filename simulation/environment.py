@@ -9,7 +9,7 @@ from simulation.settings import *
 
 class CarlaEnvironment():
 
-    def __init__(self, client, world, town, checkpoint_frequency=100, continuous_action=True) -> None:
+    def __init__(self, client, world, town, checkpoint_frequency=100, continuous_action=True, display_on=VISUAL_DISPLAY) -> None:
 
 
         self.client = client
@@ -18,15 +18,21 @@ class CarlaEnvironment():
         self.map = self.world.get_map()
         self.action_space = self.get_discrete_action_space()
         self.continous_action_space = continuous_action
-        self.display_on = VISUAL_DISPLAY
+        self.display_on = display_on
         self.vehicle = None
-        self.settings = None
         self.current_waypoint_index = 0
         self.checkpoint_waypoint_index = 0
         self.fresh_start=True
         self.checkpoint_frequency = checkpoint_frequency
         self.route_waypoints = None
         self.town = town
+
+        # Fixed time-step synchronous mode: the server only advances when we tick it
+        self.synchronous_mode = SYNCHRONOUS_MODE
+        self.settings = self.world.get_settings()
+        self.settings.synchronous_mode = self.synchronous_mode
+        self.settings.fixed_delta_seconds = FIXED_DELTA_SECONDS if self.synchronous_mode else None
+        self.world.apply_settings(self.settings)
         
         # Objects to be kept alive
         self.camera_obj = None
@@ -74,6 +80,8 @@ class CarlaEnvironment():
 
             # Camera Sensor
             self.camera_obj = CameraSensor(self.vehicle)
+            if self.synchronous_mode:
+                self.world.tick()
             while(len(self.camera_obj.front_camera) == 0):
                 time.sleep(0.0001)
             self.image_obs = self.camera_obj.front_camera.pop(-1)
@@ -140,7 +148,12 @@ class CarlaEnvironment():
             self.navigation_obs = np.array([self.throttle, self.velocity, self.previous_steer, self.distance_from_center, self.angle])
 
                         
-            time.sleep(0.5)
+            # Half a second for the vehicle to settle, the world only moves on when ticked in synchronous mode
+            if self.synchronous_mode:
+                for _ in range(round(0.5 / FIXED_DELTA_SECONDS)):
+                    self.world.tick()
+            else:
+                time.sleep(0.5)
             self.collision_history.clear()
 
             self.episode_start_time = time.time()
@@ -189,6 +202,9 @@ class CarlaEnvironment():
                     self.vehicle.apply_control(carla.VehicleControl(steer=self.previous_steer*0.9 + steer*0.1))
                 self.previous_steer = steer
                 self.throttle = 1.0
+
+            if self.synchronous_mode:
+                self.world.tick()
             
             # Traffic Light state
             if self.vehicle.is_at_traffic_light():
@@ -246,7 +262,7 @@ class CarlaEnvironment():
             elif self.distance_from_center > self.max_distance_from_center:
                 done = True
                 reward = -10
-            elif self.episode_start_time + 10 < time.time() and self.velocity < 1.0:
+            elif self.episode_time() > 10 and self.velocity < 1.0:
                 reward = -10
                 done = True
             elif self.velocity > self.max_speed:
@@ -359,6 +375,9 @@ class CarlaEnvironment():
                         walker_controller_bp, carla.Transform(), walker)
                     self.walker_list.append(walker_controller.id)
                     self.walker_list.append(walker.id)
+            # The controllers only exist on the server after a tick, they must be there before starting them
+            if self.synchronous_mode:
+                self.world.tick()
             all_actors = self.world.get_actors(self.walker_list)
 
             # set how many pedestrians can cross the road
@@ -473,6 +492,30 @@ class CarlaEnvironment():
         self.vehicle = self.world.try_spawn_actor(vehicle_bp, spawn_point)
 
 
+    # Tear down method: destroys what we've spawned and takes the server out of synchronous mode,
+    # otherwise it would stay frozen waiting for ticks from a client that is gone.
+    def close(self):
+        self.client.apply_batch([carla.command.DestroyActor(x) for x in self.sensor_list])
+        self.client.apply_batch([carla.command.DestroyActor(x) for x in self.actor_list])
+        self.client.apply_batch([carla.command.DestroyActor(x) for x in self.walker_list])
+        self.sensor_list.clear()
+        self.actor_list.clear()
+        self.walker_list.clear()
+        self.remove_sensors()
+        if self.synchronous_mode:
+            self.settings.synchronous_mode = False
+            self.settings.fixed_delta_seconds = None
+            self.world.apply_settings(self.settings)
+
+
+    # Seconds since the episode started, in simulated time when the server is synchronous
+    # as the host's clock runs at its own pace then (e.g. while waiting on the learner)
+    def episode_time(self):
+        if self.synchronous_mode:
+            return self.timesteps * FIXED_DELTA_SECONDS
+        return time.time() - self.episode_start_time
+
+
     # Clean up method
     def remove_sensors(self):
         self.camera_obj = None
@@ -11,6 +11,7 @@ Names of the parameters are self-explanatory therefore elimating the use of furt
 HOST = "localhost"
 PORT = 2000
 TIMEOUT = 20.0
+CONNECTION_ATTEMPTS = 5
 
 CAR_NAME = 'model3'
 EPISODE_LENGTH = 120
@@ -18,6 +19,8 @@ NUMBER_OF_VEHICLES = 30
 NUMBER_OF_PEDESTRIAN = 10
 CONTINUOUS_ACTION = True
 VISUAL_DISPLAY = True
+SYNCHRONOUS_MODE = True
+FIXED_DELTA_SECONDS = 0.05
 
 
 RGB_CAMERA = 'sensor.camera.rgb'
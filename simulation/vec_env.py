@@ -0,0 +1,116 @@
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from simulation.connection import ClientConnection
+from simulation.environment import CarlaEnvironment
+from simulation.settings import PORT
+
+
+# ---------------------------------------------------------------------|
+# ------------------------------- WORKER |
+# ---------------------------------------------------------------------|
+
+# Every worker process holds its own client connected to its own CARLA server,
+# and serves the commands sent over its end of the pipe.
+def worker(remote, parent_remote, town, port, env_kwargs):
+    parent_remote.close()
+    client, world = ClientConnection(town, port).connect()
+    env = CarlaEnvironment(client, world, town, **env_kwargs)
+    try:
+        while True:
+            command, data = remote.recv()
+            if command == 'step':
+                result = env.step(data)
+                # The env returns nothing when the simulation failed mid-episode
+                if result is None:
+                    result = (None, 0, True, None)
+                remote.send(result)
+            elif command == 'reset':
+                remote.send(env.reset())
+            elif command == 'close':
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+        remote.close()
+
+
+# ---------------------------------------------------------------------|
+# ------------------------------- VECTORIZED ENV |
+# ---------------------------------------------------------------------|
+
+class SubprocVecEnv:
+
+    def __init__(self, town, num_envs, **env_kwargs):
+        self.num_envs = num_envs
+
+        # Spawned rather than forked: the parent process holds a CUDA context
+        ctx = mp.get_context('spawn')
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(self.num_envs)])
+        self.processes = list()
+        for i, (work_remote, remote) in enumerate(zip(self.work_remotes, self.remotes)):
+            # Only the first env gets a display window, one per env would be of no use
+            worker_kwargs = env_kwargs if i == 0 else dict(env_kwargs, display_on=False)
+            # A CARLA server listens on two consecutive ports, so the servers are at PORT, PORT+2, ...
+            process = ctx.Process(target=worker, args=(work_remote, remote, town, PORT + 2*i, worker_kwargs), daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+
+    # Resets the given envs (all of them by default) and returns their first observations.
+    def reset(self, indices=None):
+        remotes = self._remotes(indices)
+        for remote in remotes:
+            remote.send(('reset', None))
+        return self._gather(remotes)
+
+
+    # Sends the actions to the given envs (all of them by default) without waiting for the result,
+    # every env must have one step in flight when step_wait() is called.
+    def step_async(self, actions, indices=None):
+        for remote, action in zip(self._remotes(indices), actions):
+            remote.send(('step', action))
+
+
+    def step_wait(self):
+        observations, rewards, dones, infos = zip(*self._gather(self.remotes))
+        return list(observations), list(rewards), list(dones), list(infos)
+
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+
+    # Lets every worker restore its server's settings before it exits
+    def close(self):
+        for remote in self.remotes:
+            try:
+                remote.send(('close', None))
+            except BrokenPipeError:
+                # That worker has exited already
+                pass
+        for process in self.processes:
+            process.join()
+
+
+    def _remotes(self, indices):
+        if indices is None:
+            return list(self.remotes)
+        return [self.remotes[i] for i in indices]
+
+
+    # Receives one reply per remote as soon as each one is ready, so a slow server doesn't
+    # hold back reading the others. Replies are returned in the order of the remotes.
+    def _gather(self, remotes):
+        replies = dict()
+        pending = list(remotes)
+        while pending:
+            for remote in wait(pending):
+                try:
+                    replies[remote] = remote.recv()
+                except EOFError:
+                    raise ConnectionError('A CARLA environment worker has exited, e.g. it could not connect to its server.')
+                pending.remove(remote)
+        return [replies[remote] for remote in remotes]